@@ -9,6 +9,7 @@ import time
 import threading
 import shutil
 import cv2
+from collections import deque
 
 stop_search_event = threading.Event()
 
@@ -24,12 +25,30 @@ IN4_A = 23
 
 CONFIDENCE_THRESHOLD = 0.08
 running_search = False
-JSON_FILE_PATH = "/home/pi/frame_annotated/annotations.json"
+JSON_FILE_PATH = "/home/pi/frame_annotated/annotations.jsonl"  # One JSON object per line, appended by rpicam_infer.py
 ANNOTATED_PATH = "/home/pi/frame_annotated"
 STREAM_PATH =  "/home/pi/frame_debug"
 CONFIDENCE_THRESHOLD = 0
 IMAGE_WIDTH = 640
 
+# Continuous-rotation search. The tank keeps turning while rpicam_infer.py runs
+# the detector on every frame; the turn rate is limited by motion blur during
+# the exposure and by how many inferences we want while a stem crosses the view.
+CONTINUOUS_SEARCH = True            # False falls back to the stop-and-wait scan
+CAMERA_HFOV_DEG = 66.0              # Horizontal field of view of the camera module
+CAMERA_EXPOSURE_S = 0.010           # Assumed longest shutter with SEARCH_CAMERA_ARGS outdoors in daylight
+SEARCH_CAMERA_ARGS = "--exposure sport"  # Auto exposure that raises gain before lengthening the shutter
+SEARCH_CAMERA_ENV_FILE = "/run/rpicam-vid-search.env"  # Read by rpicam-vid.service
+MAX_BLUR_PX = 12                    # Smear across the image the model still detects through
+INFERENCES_PER_STEM = 3             # Detector passes wanted while a stem is in view
+DEFAULT_INFERENCE_PERIOD_S = 0.5    # Used until annotations.jsonl has enough frames to measure it
+ROTATION_DEG_PER_SEC_AT_FULL = 180  # Measured on-the-spot turn rate at motor speed 1.0
+MIN_ROTATE_SPEED = 0.3              # Below this the treads stall
+MAX_ROTATE_SPEED = 0.5
+ROTATE_TANK_SIGN = 1                # 1 if rotate_tank() pans the camera towards the right of the image, else -1
+SEARCH_POLL_INTERVAL = 0.05
+MAX_DETECTION_LATENCY_S = 20        # Capture-to-publish delay the heading log covers; older detections are skipped
+
 
 def find_joystick_device():
     devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
@@ -140,7 +159,8 @@ def handle_event(event):
                 stop_search_event.set()
                 logging.debug("Stream to http button")
                 stop_service("rpicam-auto.service")
-                start_service("rpicam-vid.service")
+                set_search_camera(False)
+                restart_service("rpicam-vid.service")  # Back to the default exposure
                 if running_search == True:
                     finalize_folders()
                 running_search = False
@@ -149,18 +169,21 @@ def handle_event(event):
                 stop_search_event.set()
                 logging.debug("Stream to file button")
                 stop_service("rpicam-auto.service")
+                set_search_camera(False)
                 start_service("rpicam-file.service")
                 if running_search == True:
                     finalize_folders()                
                 running_search = False
             elif event.code == SEARCH_FOR_KNOTWEED and event.value == 1:  #X
                 stop_motors()  # Ensure motors are stopped before starting search
-                start_service("rpicam-vid.service")
+                set_search_camera(CONTINUOUS_SEARCH)
+                restart_service("rpicam-vid.service")  # Pick up the search exposure
                 stop_service("rpicam-file.service")
                 start_service("rpicam-auto.service")
                 
                 running_search = True
-                search_thread = threading.Thread(target=run_knotweed_search, daemon=True)
+                search = run_continuous_knotweed_search if CONTINUOUS_SEARCH else run_knotweed_search
+                search_thread = threading.Thread(target=search, daemon=True)
                 search_thread.start()
 
                 
@@ -175,7 +198,52 @@ def start_service(service_name):
 
 def restart_service(service_name):
     subprocess.run(["sudo", "systemctl", "restart", service_name], check=True)
+
+def set_search_camera(enabled):
+    """Switches rpicam-vid.service to the short-exposure search settings, applied on its next (re)start."""
+    if enabled:
+        with open(SEARCH_CAMERA_ENV_FILE, "w") as f:
+            f.write(f"SEARCH_CAMERA_ARGS={SEARCH_CAMERA_ARGS}\n")
+    elif os.path.exists(SEARCH_CAMERA_ENV_FILE):
+        os.remove(SEARCH_CAMERA_ENV_FILE)
     
+def read_annotations(position=None):
+    """Returns (frames, new_position) for the complete lines in the JSON lines file after position.
+
+    Pass the returned position back in to read only the frames published since the last call.
+    A line still being written has no trailing newline yet and is left for next time.
+    rpicam_infer.py recreates the file whenever it (re)starts, so a position in a
+    replaced or truncated file starts over from the beginning of the new one.
+    """
+    inode, offset = position if position is not None else (None, 0)
+    try:
+        with open(JSON_FILE_PATH, "rb") as file:
+            stat = os.fstat(file.fileno())
+            if stat.st_ino != inode or stat.st_size < offset:
+                if inode is not None:
+                    logging.info(f"{JSON_FILE_PATH} was recreated, reading it from the start")
+                inode, offset = stat.st_ino, 0
+            file.seek(offset)
+            chunk = file.read()
+    except FileNotFoundError:
+        return [], position
+    except Exception as e:
+        logging.error(f"Error reading {JSON_FILE_PATH}: {e}")
+        return [], position
+
+    complete = chunk[:chunk.rfind(b"\n") + 1]
+    frames = []
+    for line in complete.splitlines():
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            logging.error(f"Error decoding JSON line in {JSON_FILE_PATH}: {line!r}")
+            continue
+        if isinstance(entry, dict):
+            frames.append(entry)
+    return frames, (inode, offset + len(complete))
+
+
 def detect_knotweed():
     logging.debug(f"Looking for file {JSON_FILE_PATH}")
     
@@ -183,29 +251,11 @@ def detect_knotweed():
         return None, None  # No file means no detections yet
 
     logging.debug("JSON FILE DETECTED!")
-    
-    try:
-        with open(JSON_FILE_PATH, "r") as file:
-            logging.debug("Opened the JSON file")
-            data = json.load(file)  # Ensure data is a list
-            logging.debug(f"Data loaded: {data}")
-    except json.JSONDecodeError:
-        logging.error(f"Error decoding JSON in {JSON_FILE_PATH}")
-        return None, None  # Handle incomplete JSON
-    except Exception as e:
-        logging.error(f"Error reading or processing in detect {JSON_FILE_PATH}: {e}")
-        return None, None  # Handle other errors
-
-    if not isinstance(data, list):
-        logging.error("JSON data is not a list, check file format!")
-        return None, None
+    data, _ = read_annotations()
+    logging.debug(f"Data loaded: {data}")
 
     # Iterate over each entry in the list
     for entry in data:
-        if not isinstance(entry, dict):
-            logging.warning("Skipping non-dictionary entry in JSON list")
-            continue  # Skip if entry is not a dictionary
-        
         if "detections" in entry:
             logging.debug("IN DETECTIONS")
             filename = entry.get("image_file", "unknown_filename.jpg")  # Default if missing
@@ -222,8 +272,149 @@ def detect_knotweed():
 
     return None, None  # No valid detection found
 
-def navigate_to_knotweed(detection, filename):
-    """Continuously adjusts robot movement based on latest detection data for 4 seconds."""
+def latest_knotweed_detection(frames, since):
+    """Returns (detection, filename, capture_time) for the newest frame captured after since with a stem in it."""
+    for frame in reversed(frames):
+        capture_time = frame.get("capture_time")
+        if capture_time is None or capture_time <= since:
+            break
+
+        stems = [d for d in frame.get("detections", [])
+                 if d.get("class_name") == "knotweed-stems" and d.get("confidence", 0) >= CONFIDENCE_THRESHOLD]
+        if stems:
+            detection = max(stems, key=lambda d: d.get("confidence", 0))
+            return detection, frame.get("image_file", "unknown_filename.jpg"), capture_time
+
+    return None, None, None
+
+
+def measured_inference_period(capture_times):
+    """Average time between the recent frames the detector finished."""
+    if len(capture_times) < 3:
+        return DEFAULT_INFERENCE_PERIOD_S
+    return (capture_times[-1] - capture_times[0]) / (len(capture_times) - 1)
+
+
+def search_rotate_speed(inference_period):
+    """Motor speed for the continuous search, tuned to the camera exposure and inference rate.
+
+    Returns (speed, wanted) where wanted is what the blur and coverage limits ask for
+    before clamping, so the caller can tell when the treads can't go that slowly.
+    """
+    blur_limit = MAX_BLUR_PX * (CAMERA_HFOV_DEG / IMAGE_WIDTH) / CAMERA_EXPOSURE_S
+    coverage_limit = CAMERA_HFOV_DEG / (INFERENCES_PER_STEM * inference_period)
+    wanted = min(blur_limit, coverage_limit) / ROTATION_DEG_PER_SEC_AT_FULL
+    return clamp(wanted, MIN_ROTATE_SPEED, MAX_ROTATE_SPEED), wanted
+
+
+def log_search_speed(speed, wanted, inference_period):
+    if wanted < MIN_ROTATE_SPEED:
+        deg_per_sec = speed * ROTATION_DEG_PER_SEC_AT_FULL
+        blur_px = deg_per_sec * CAMERA_EXPOSURE_S * IMAGE_WIDTH / CAMERA_HFOV_DEG
+        inferences = CAMERA_HFOV_DEG / (deg_per_sec * inference_period)
+        logging.warning(f"Search wants rotation speed {wanted:.2f} but the treads stall below {MIN_ROTATE_SPEED}; "
+                        f"turning at {speed:.2f} gives {blur_px:.1f}px blur and {inferences:.1f} inferences per stem")
+    else:
+        logging.debug(f"Search rotation speed {speed:.2f} for an inference period of {inference_period:.2f}s")
+
+
+def heading_at(heading_log, when):
+    """Interpolates the tank heading (degrees turned since the search began) at time when."""
+    previous_time, previous_heading = heading_log[0]
+    if when <= previous_time:
+        return previous_heading
+    for log_time, heading in heading_log:
+        if log_time >= when:
+            fraction = (when - previous_time) / (log_time - previous_time)
+            return previous_heading + fraction * (heading - previous_heading)
+        previous_time, previous_heading = log_time, heading
+    return previous_heading
+
+
+def turn_by(degrees, speed):
+    """Turns on the spot by roughly degrees (positive pans the camera to the right of the image)."""
+    duration = abs(degrees) / (speed * ROTATION_DEG_PER_SEC_AT_FULL)
+    direction = ROTATE_TANK_SIGN if degrees > 0 else -ROTATE_TANK_SIGN
+    rotate_tank(speed, direction)
+    time.sleep(duration)
+    stop_tank()
+
+
+def run_continuous_knotweed_search():
+    """Rotates the tank without stopping until a stem is detected, then turns back to where the stem is now."""
+    global running_search
+    logging.debug("Starting continuous knotweed search...")
+    stop_search_event.clear()
+
+    search_start = time.time()
+    inference_period = DEFAULT_INFERENCE_PERIOD_S
+    speed, wanted = search_rotate_speed(inference_period)
+    log_search_speed(speed, wanted, inference_period)
+    heading = 0.0
+    last_time = search_start
+    heading_log = deque([(search_start, heading)],
+                        maxlen=int(MAX_DETECTION_LATENCY_S / SEARCH_POLL_INTERVAL) + 2)
+    capture_times = deque(maxlen=10)
+    _, position = read_annotations()  # Only frames published from now on
+    rotate_tank(speed)
+
+    while not stop_search_event.is_set():
+        time.sleep(SEARCH_POLL_INTERVAL)
+        now = time.time()
+        heading += ROTATE_TANK_SIGN * speed * ROTATION_DEG_PER_SEC_AT_FULL * (now - last_time)
+        last_time = now
+        heading_log.append((now, heading))
+
+        frames, position = read_annotations(position)
+        capture_times.extend(f["capture_time"] for f in frames if f.get("capture_time", 0) > search_start)
+        detection, filename, capture_time = latest_knotweed_detection(frames, search_start)
+        if detection and capture_time < heading_log[0][0]:
+            logging.warning(f"Skipping detection captured {now - capture_time:.1f}s ago, "
+                            f"older than the {MAX_DETECTION_LATENCY_S}s heading log")
+            detection = None
+
+        if detection:
+            stop_tank()
+            heading += ROTATE_TANK_SIGN * speed * ROTATION_DEG_PER_SEC_AT_FULL * (time.time() - last_time)
+
+            # Bearing of the stem when the frame was taken, minus how far we have turned since then
+            bbox_center_x = (detection['bbox'][0] + detection['bbox'][2]) / 2
+            bearing = (bbox_center_x - IMAGE_WIDTH / 2) / IMAGE_WIDTH * CAMERA_HFOV_DEG
+            turned_since_capture = heading - heading_at(heading_log, capture_time)
+            correction = bearing - turned_since_capture
+            logging.debug(f"Knotweed detected at {bearing:.1f} deg, turned {turned_since_capture:.1f} deg "
+                          f"since capture. Turning back {correction:.1f} deg.")
+            turn_by(correction, speed)
+            turned_back = time.time()
+
+            # The stem should now be dead ahead, so steer straight until a frame taken
+            # after the turn-back says otherwise. Earlier frames were taken facing elsewhere.
+            half_width = (detection['bbox'][2] - detection['bbox'][0]) / 2
+            centered = dict(detection, bbox=[int(IMAGE_WIDTH / 2 - half_width), detection['bbox'][1],
+                                              int(IMAGE_WIDTH / 2 + half_width), detection['bbox'][3]])
+            navigate_to_knotweed(centered, filename, since=turned_back)
+            running_search = False
+            return
+
+        if frames:
+            inference_period = measured_inference_period(capture_times)
+            new_speed, wanted = search_rotate_speed(inference_period)
+            if abs(new_speed - speed) > 0.01:
+                logging.debug(f"Retuning search rotation speed from {speed:.2f} to {new_speed:.2f}")
+                log_search_speed(new_speed, wanted, inference_period)
+                speed = new_speed
+                rotate_tank(speed)
+
+    logging.debug("Search interrupted.")
+    stop_tank()
+    running_search = False
+
+
+def navigate_to_knotweed(detection, filename, since=None):
+    """Continuously adjusts robot movement based on latest detection data for 4 seconds.
+
+    If since is given, only frames captured after that time replace the detection passed in.
+    """
     try:
         global IMAGE_WIDTH, JSON_FILE_PATH
         first_iteration = True
@@ -235,27 +426,28 @@ def navigate_to_knotweed(detection, filename):
                 # Read the latest detection data
                 if first_iteration == False:
                     logging.info(f"the file being read {JSON_FILE_PATH}")
-                    with open(JSON_FILE_PATH, 'r') as f:
-                        data = json.load(f)
-                        
-                        # Loop through each frame in the data
-                        for frame in data:
-                            # Find all detections with class_name 'knotweed-stems' in the current frame
-                            detections = frame.get("detections", [])
-                            knotweed_detections = [d for d in detections if d.get("class_name") == "knotweed-stems"]
-
-                            if knotweed_detections:
-                                # Get the highest confidence detection in the current frame
-                                detection = max(knotweed_detections, key=lambda d: d.get("confidence", 0))
-                                # Get the image_file associated with this frame
-                                filename = frame.get("image_file", "default_filename.jpg")  #Since we are navigating, it may be a newer detection than the original one
-                                logging.info(f"Selected detection: {detection}")
-                                logging.info(f"Image file: {filename}")
-                            else:
-                                logging.error("No 'knotweed-stems' detections found in this frame.")
-                                filename = "default_filename.jpg"
-                        
-                        
+                    data, _ = read_annotations()
+                    if since is not None:
+                        data = [frame for frame in data if frame.get("capture_time", 0) > since]
+                    
+                    # Loop through each frame in the data
+                    for frame in data:
+                        # Find all detections with class_name 'knotweed-stems' in the current frame
+                        detections = frame.get("detections", [])
+                        knotweed_detections = [d for d in detections if d.get("class_name") == "knotweed-stems"]
+
+                        if knotweed_detections:
+                            # Get the highest confidence detection in the current frame
+                            detection = max(knotweed_detections, key=lambda d: d.get("confidence", 0))
+                            # Get the image_file associated with this frame
+                            filename = frame.get("image_file", "default_filename.jpg")  #Since we are navigating, it may be a newer detection than the original one
+                            logging.info(f"Selected detection: {detection}")
+                            logging.info(f"Image file: {filename}")
+                        else:
+                            logging.error("No 'knotweed-stems' detections found in this frame.")
+                            filename = "default_filename.jpg"
+                    
+                    
                     logging.info(f"The json loaded was {detection}")
                 else:
                     first_iteration = False
@@ -416,11 +608,14 @@ def initialize_folder():
         print(f"The folder {folder_path} does not exist or is not a directory.")
 
 # Example motor control functions
-def rotate_tank():
-    """Placeholder function to rotate the tank."""
-    speed = .5
-    motor_a.forward(abs(speed))
-    motor_b.backward(abs(speed))
+def rotate_tank(speed=.5, direction=1):
+    """Rotates the tank on the spot. direction -1 turns the other way."""
+    if direction > 0:
+        motor_a.forward(abs(speed))
+        motor_b.backward(abs(speed))
+    else:
+        motor_a.backward(abs(speed))
+        motor_b.forward(abs(speed))
     print(f"Rotating tank at speed {speed}...")
 
 def stop_tank():
@@ -4,75 +4,289 @@ from ultralytics import YOLO
 import os
 import time
 import json
+import threading
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import torch
 
 # Logging setup
 logging.basicConfig(filename='/home/pi/rpicam_infer.log', level=logging.DEBUG)
 
 # YOLO Model Path
 model_path = "/home/pi/Projects/models/best.pt"
-model = YOLO(model_path)
-logging.info(f"Model loaded from {model_path}")
+model = None  # Loaded by load_model(), in this process or in each inference worker
 
 # Confidence threshold for inference
 confidence_threshold = 0.08
 
+# Execution mode, set from rpicam-auto.service so both can be tried on the robot.
+# 0 workers runs model.predict in this process; N > 0 runs N worker processes.
+# torch_threads is the intra-op thread count per worker. Unset or 0 splits the
+# cores evenly between workers, or keeps torch's default when running in-process.
+inference_workers = int(os.environ.get("INFERENCE_WORKERS", "0"))
+torch_threads = int(os.environ.get("TORCH_THREADS", "0"))
 
+# Keep an unannotated copy of every frame for retraining. Set SAVE_RAW_FRAMES=0
+# to skip the second JPEG encode per frame on the inference path.
+save_raw_frames = os.environ.get("SAVE_RAW_FRAMES", "1") == "1"
 
-def infer(frame, output_infer_dir, json_output_file):
-    """Run inference on the frame, save the annotated frame, and log results in JSON."""
-    # Perform inference using the model
+
+def threads_per_worker(workers, threads):
+    """The torch thread count each worker is pinned to, or 0 for torch's default in-process."""
+    if threads == 0 and workers > 0:
+        # torch defaults to one thread per core in every process, which would
+        # oversubscribe the cores workers times over
+        return max(1, (os.cpu_count() or 1) // workers)
+    return threads
+
+
+def load_model(threads=0):
+    """Load the YOLO model into this process, optionally pinning torch's thread count."""
+    global model
+    if threads > 0:
+        torch.set_num_threads(threads)
+    model = YOLO(model_path)
+    logging.info(f"Model loaded from {model_path} (pid {os.getpid()}, {torch.get_num_threads()} threads)")
+
+
+def frame_timestamp(capture_time):
+    """Timestamp used in file names, with milliseconds so back-to-back frames don't overwrite each other."""
+    millis = int((capture_time % 1) * 1000)
+    return f"{time.strftime('%H-%M-%S', time.gmtime(capture_time))}-{millis:03d}"
+
+
+def predict(frame):
+    """Run the model on the frame and return [(x1, y1, x2, y2, confidence, class_name), ...]."""
     results = model.predict(frame, conf=confidence_threshold)
-    
+
     # Log results to verify detections
     if not results:
         logging.warning("No results returned from the model.")
-    
-    timestamp = time.strftime('%H-%M-%S', time.gmtime(time.time()))
-    annotated_filename = os.path.join(output_infer_dir, f"annotated_{timestamp}.jpg")
-    frame_data = {"timestamp": timestamp, "image_file": annotated_filename, "detections": []}
 
-    # Annotate the frame with results
+    boxes = []
     for result in results:
         if hasattr(result, 'boxes') and result.boxes is not None:
             for box in result.boxes.data:
-                x1, y1, x2, y2, conf, cls = box[:6]
+                x1, y1, x2, y2, conf, cls = box[:6].tolist()
                 logging.debug(f"Detected box: {x1}, {y1}, {x2}, {y2}, Confidence: {conf}")
+                boxes.append((x1, y1, x2, y2, conf, model.names[int(cls)]))
+    return boxes
+
+
+def save_raw_frame(frame, output_dir, capture_time):
+    timestamp = frame_timestamp(capture_time)
+    frame_filename = os.path.join(output_dir, f"frame_{timestamp}.jpg")
+    cv2.imwrite(frame_filename, frame)
+    logging.info(f"Saved raw frame: {frame_filename}")
+
 
-                if conf >= confidence_threshold:
-                    class_name = model.names[int(cls)]
-                    
-                    # Draw bounding boxes and labels
-                    cv2.rectangle(frame, (int(x1), int(y1)), (int(x2), int(y2)), (0, 255, 0), 2)
-                    label = f"{class_name} ({conf:.2f})"
-                    cv2.putText(frame, label, (int(x1), int(y1) - 10),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
-
-                    # Append detection details to frame data
-                    frame_data["detections"].append({
-                        "class_name": class_name,
-                        "confidence": float(conf),
-                        "bbox": [int(x1), int(y1), int(x2), int(y2)]
-                    })
+def process_frame(frame, capture_time, output_dir, output_infer_dir):
+    """Run inference on the frame and save the annotated frame. Returns the frame's JSON data."""
+    if save_raw_frames:
+        save_raw_frame(frame, output_dir, capture_time)
+
+    boxes = predict(frame)
+
+    # capture_time lets the search in joystick.py work out how far the tank
+    # has turned since this frame was taken.
+    timestamp = frame_timestamp(capture_time)
+    annotated_filename = os.path.join(output_infer_dir, f"annotated_{timestamp}.jpg")
+    frame_data = {"timestamp": timestamp, "capture_time": capture_time,
+                  "image_file": annotated_filename, "detections": []}
+
+    # Annotate the frame with results
+    for x1, y1, x2, y2, conf, class_name in boxes:
+        if conf >= confidence_threshold:
+            # Draw bounding boxes and labels
+            cv2.rectangle(frame, (int(x1), int(y1)), (int(x2), int(y2)), (0, 255, 0), 2)
+            label = f"{class_name} ({conf:.2f})"
+            cv2.putText(frame, label, (int(x1), int(y1) - 10),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+
+            # Append detection details to frame data
+            frame_data["detections"].append({
+                "class_name": class_name,
+                "confidence": float(conf),
+                "bbox": [int(x1), int(y1), int(x2), int(y2)]
+            })
 
     # Save annotated frame
     cv2.imwrite(annotated_filename, frame)
     logging.info(f"Saved annotated frame: {annotated_filename}")
+    return frame_data
 
-    # Append frame data to JSON file
+
+def publish(frame_data, json_output_file):
+    """Append the frame's detections to the JSON file."""
+    # Append frame data as one JSON line, so each frame costs the same no matter
+    # how long the run is and readers never see a half-rewritten file
     try:
-        with open(json_output_file, "r+") as f:
-            data = json.load(f)
-            data.append(frame_data)
-            f.seek(0)
-            json.dump(data, f, indent=4)
+        with open(json_output_file, "a") as f:
+            f.write(json.dumps(frame_data) + "\n")
         logging.info(f"Frame data appended to JSON: {frame_data}")
     except Exception as e:
         logging.error(f"Error while writing to JSON file: {str(e)}")
 
 
-def capture_frames(url, interval):
-    """Capture frames from the video stream at a set interval."""
+def infer(frame, output_dir, output_infer_dir, json_output_file, capture_time=None):
+    """Run inference on the frame, save the annotated frame, and log results in JSON."""
+    if capture_time is None:
+        capture_time = time.time()
+    publish(process_frame(frame, capture_time, output_dir, output_infer_dir), json_output_file)
+
+
+def warm_up(frame_shape):
+    """Run the model once on a blank frame so the first real frame isn't timed with torch's lazy setup."""
+    predict(np.zeros(frame_shape, dtype=np.uint8))
+
+
+def inference_worker(slot_names, frame_shape, threads, output_dir, output_infer_dir, tasks, results, ready):
+    """Worker process: run the model on frames handed over in shared memory slots."""
+    load_model(threads)
+    warm_up(frame_shape)
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    frames = [np.ndarray(frame_shape, dtype=np.uint8, buffer=slot.buf) for slot in slots]
+    ready.put(os.getpid())
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        frame_id, slot, capture_time = task
+        try:
+            frame_data = process_frame(frames[slot], capture_time, output_dir, output_infer_dir)
+        except Exception as e:
+            logging.error(f"Inference failed on frame {frame_id}: {str(e)}")
+            frame_data = None
+        results.put((frame_id, slot, frame_data))
+
+    del frames
+    for slot in slots:
+        slot.close()
+
+
+class InferencePool:
+    """Runs process_frame() in worker processes and hands results back in frame order.
+
+    Frames are copied into shared memory slots rather than pickled through the
+    queue, one slot per worker. Workers also save the annotated jpg, so the
+    parent only has to append each frame's JSON line once the frames before it
+    are done. The constructor returns once every worker has loaded the model.
+    """
+
+    def __init__(self, workers, threads, frame_shape, output_dir, output_infer_dir):
+        self.workers = workers
+        frame_size = int(np.prod(frame_shape))
+        self.slots = [shared_memory.SharedMemory(create=True, size=frame_size) for _ in range(workers)]
+        self.frames = [np.ndarray(frame_shape, dtype=np.uint8, buffer=slot.buf) for slot in self.slots]
+        self.free_slots = list(range(len(self.slots)))
+        self.finished = {}
+        self.submitted = 0
+        self.next_to_publish = 0
+
+        # spawn rather than fork: forking a process that has torch threads running can deadlock
+        context = multiprocessing.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        ready = context.Queue()
+        slot_names = [slot.name for slot in self.slots]
+        self.processes = [context.Process(target=inference_worker, daemon=True,
+                                          args=(slot_names, frame_shape, threads, output_dir, output_infer_dir,
+                                                self.tasks, self.results, ready))
+                          for _ in range(workers)]
+        try:
+            for process in self.processes:
+                process.start()
+            ready_workers = 0
+            while ready_workers < workers:
+                try:
+                    ready.get(timeout=1)
+                    ready_workers += 1
+                except queue.Empty:
+                    self.check_workers()
+        except BaseException:
+            self.close()
+            raise
+        logging.info(f"Started {workers} inference workers with {threads} torch threads each")
+
+    def check_workers(self):
+        """Raise if a worker has died, since its frame would otherwise hold back every later one forever."""
+        for process in self.processes:
+            if not process.is_alive():
+                raise RuntimeError(f"Inference worker {process.pid} exited with code {process.exitcode}")
+
+    def has_capacity(self):
+        """True if a worker is idle and its slot is free for the next frame."""
+        self.check_workers()
+        return bool(self.free_slots)
+
+    def submit(self, frame, capture_time):
+        slot = self.free_slots.pop()
+        self.frames[slot][:] = frame
+        self.tasks.put((self.submitted, slot, capture_time))
+        self.submitted += 1
+
+    def ordered_results(self):
+        """Yield the frame data of every frame that is next in order and finished (None if inference failed)."""
+        self.check_workers()
+        while True:
+            try:
+                frame_id, slot, frame_data = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.free_slots.append(slot)
+            self.finished[frame_id] = frame_data
+
+        while self.next_to_publish in self.finished:
+            yield self.finished.pop(self.next_to_publish)
+            self.next_to_publish += 1
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            if process.pid is not None:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+        del self.frames
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+
+
+def grab_latest_frames(cap, latest_frame, frame_lock, stop_event):
+    """Read the stream as fast as it delivers frames, keeping only the newest one.
+
+    Inference is slower than the 15 fps stream, so without this the decoder
+    buffer backs up and the model ends up looking at frames that are seconds old.
+    """
+    while not stop_event.is_set():
+        ret, frame = cap.read()
+        if not ret:
+            logging.warning("Frame capture returned False. No frame received.")
+            time.sleep(0.05)
+            continue
+
+        with frame_lock:
+            latest_frame["frame"] = frame
+            latest_frame["capture_time"] = time.time()
+
+
+def capture_frames(url, interval, max_frames=100):
+    """Run inference on frames from the video stream.
+
+    An interval of 0 runs the detector on every frame it can keep up with,
+    always taking the newest one; otherwise a frame is taken every interval seconds.
+    """
     logging.info("Starting camera inference script...")
+    if inference_workers < 0 or torch_threads < 0:
+        logging.error(f"INFERENCE_WORKERS ({inference_workers}) and TORCH_THREADS ({torch_threads}) "
+                      "must not be negative.")
+        raise ValueError("INFERENCE_WORKERS and TORCH_THREADS must not be negative")
+
     cap = cv2.VideoCapture(url)
 
     if not cap.isOpened():
@@ -97,13 +311,13 @@ def capture_frames(url, interval):
                 os.remove(file_path)
     
     # JSON output file
-    json_output_file = "/home/pi/frame_annotated/annotations.json"
+    json_output_file = "/home/pi/frame_annotated/annotations.jsonl"
 
     # Check if the JSON file exists, if not, create it
     if not os.path.exists(json_output_file):
         try:
             with open(json_output_file, "w") as f:
-                json.dump([], f)
+                pass
             logging.info(f"Created new JSON file at {json_output_file}")
         except Exception as e:
             logging.error(f"Failed to create JSON file: {str(e)}")
@@ -111,42 +325,95 @@ def capture_frames(url, interval):
 
 
 
-    start_time = time.time()
-    frame_count = 0
+    latest_frame = {"frame": None, "capture_time": None}
+    frame_lock = threading.Lock()
+    stop_event = threading.Event()
+    reader_thread = threading.Thread(target=grab_latest_frames,
+                                     args=(cap, latest_frame, frame_lock, stop_event), daemon=True)
+    reader_thread.start()
 
-    while True:
-        cap.grab()  # Attempt to grab a frame
+    pool = None
+    try:
+        # Load and warm up the model(s) before starting the clock, so the fps and
+        # latency below are steady state in both execution modes
+        frame_shape = None
+        while frame_shape is None:
+            time.sleep(0.01)
+            with frame_lock:
+                if latest_frame["frame"] is not None:
+                    frame_shape = latest_frame["frame"].shape
+        threads = threads_per_worker(inference_workers, torch_threads)
+        if inference_workers == 0:
+            load_model(threads)
+            warm_up(frame_shape)
+            threads = torch.get_num_threads()
+        else:
+            pool = InferencePool(inference_workers, threads, frame_shape, output_dir, annotated_dir)
 
-        if time.time() - start_time >= interval:
-            logging.info("Grabbed a frame")
-            ret, frame = cap.read()  # Decode the grabbed frame
-            if not ret:
-                logging.warning("Frame capture returned False. No frame received.")
+        last_capture_time = 0
+        frame_count = 0
+        latencies = []
+        start_time = time.time()
+
+        while frame_count < max_frames:
+            if pool is not None:
+                for frame_data in pool.ordered_results():
+                    if frame_data is not None:
+                        publish(frame_data, json_output_file)
+                        latencies.append(time.time() - frame_data["capture_time"])
+                    frame_count += 1
+                if pool.submitted >= max_frames or not pool.has_capacity():
+                    time.sleep(0.005)
+                    continue
+
+            with frame_lock:
+                frame = latest_frame["frame"]
+                capture_time = latest_frame["capture_time"]
+                latest_frame["frame"] = None  # Never run inference on the same frame twice
+
+            if frame is None or capture_time - last_capture_time < interval:
+                time.sleep(0.01)
                 continue
 
-            # Save the raw frame
-            timestamp = time.strftime('%H-%M-%S', time.gmtime(time.time()))
-            frame_filename = os.path.join(output_dir, f"frame_{timestamp}.jpg")
-            cv2.imwrite(frame_filename, frame)
-            logging.info(f"Saved raw frame: {frame_filename}")
+            logging.info("Grabbed a frame")
 
             # Perform inference and save annotated frame
-            infer(frame, annotated_dir, json_output_file)
+            if pool is None:
+                infer(frame, output_dir, annotated_dir, json_output_file, capture_time)
+                latencies.append(time.time() - capture_time)
+                frame_count += 1
+            else:
+                pool.submit(frame, capture_time)
 
-            start_time = time.time()
-            frame_count += 1
+            last_capture_time = capture_time
 
-        # Stop after a certain number of frames (optional)
-        if frame_count > 100:
-            logging.info("Captured 100 frames. Exiting.")
-            break
+        elapsed = time.time() - start_time
+        latencies.sort()
+        if latencies:
+            median_latency = latencies[len(latencies) // 2]
+            p95_latency = latencies[int(len(latencies) * 0.95)]
+        else:
+            median_latency = p95_latency = float("nan")
+        logging.info(f"{inference_workers} workers x {threads} threads: {frame_count} frames in "
+                     f"{elapsed:.1f}s ({frame_count / elapsed:.2f} fps), capture to publish "
+                     f"median {median_latency:.3f}s, p95 {p95_latency:.3f}s. Exiting.")
+    except Exception:
+        # Exit non-zero so systemd restarts the service rather than leaving it stuck
+        logging.exception("Inference stopped")
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+        stop_event.set()
+        reader_thread.join(timeout=1)
 
     cap.release()
     logging.info("Camera inference script completed.")
 
 if __name__ == "__main__":
     stream_url = "tcp://127.0.0.1:8080"
-    capture_interval = 1.5
-    capture_frames(stream_url, capture_interval)
+    capture_interval = 0  # Every frame, for the continuous-rotation search in joystick.py
+    max_frames = 1000
+    capture_frames(stream_url, capture_interval, max_frames)
 
 